@@ -1,8 +1,15 @@
 
-import os, re, csv, glob, textwrap, datetime
+import os, io, re, csv, glob, json, math, time, queue, atexit, sqlite3, textwrap, threading, datetime
+from collections import Counter, OrderedDict
+from contextlib import closing
+from functools import lru_cache
+from hashlib import blake2b
 from urllib.parse import urlencode, urlparse, urljoin, quote, unquote
-from flask import Flask, request, render_template, redirect, url_for, make_response, send_from_directory, abort
-from bs4 import BeautifulSoup
+from flask import Flask, Response, request, render_template, redirect, url_for, make_response, send_from_directory, abort
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import escape
+import lxml.html
+from lxml import etree
 import google.generativeai as genai
 
 # ------------------------------
@@ -14,17 +21,30 @@ WEBPAGES2_DIR = os.path.join(APP_ROOT, "webpages2")
 LOGS_DIR = os.path.join(APP_ROOT, "logs")
 os.makedirs(LOGS_DIR, exist_ok=True)
 
+EVENTS_DB = os.path.join(LOGS_DIR, "events.db")
+# Pre-sqlite event log; imported into EVENTS_DB on first start
 EVENTS_LOG = os.path.join(LOGS_DIR, "events.csv")
 SUBMISSIONS_LOG = os.path.join(LOGS_DIR, "submissions.csv")
+OVERVIEW_CACHE_DB = os.path.join(LOGS_DIR, "overview_cache.db")
+# Log rows that could not be written to their destination, one JSON object per line
+UNWRITTEN_LOG = os.path.join(LOGS_DIR, "unwritten_rows.jsonl")
+# Pages per directory considered for ranking
+PAGES_LIMIT = 80
+# Saved pages don't change during a study, so browsers may keep them for a day
+PAGE_MAX_AGE = 86400
 
 ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD", "gour")
 GENAI_KEY = os.environ.get("GEMINI_API_KEY", "")
+# Seconds to wait for Gemini before falling back to the local overview
+GENAI_TIMEOUT = float(os.environ.get("GEMINI_TIMEOUT", "30"))
+GENAI_MODEL = "gemini-1.5-flash"
 
 # Initialize Gemini (if key present)
+_MODEL = None
 if GENAI_KEY:
     try:
-        import google.generativeai as genai
         genai.configure(api_key=GENAI_KEY)
+        _MODEL = genai.GenerativeModel(GENAI_MODEL)
         _GENAI_READY = True
     except Exception:
         _GENAI_READY = False
@@ -32,10 +52,18 @@ else:
     _GENAI_READY = False
 
 app = Flask(__name__)
+# compiled templates are shared by all workers and survive restarts
+os.makedirs(os.path.join(LOGS_DIR, "jinja_cache"), exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(os.path.join(LOGS_DIR, "jinja_cache"))
 
 # ------------------------------
 # Helpers
 # ------------------------------
+_WS_RE = re.compile(r"\s+")
+_NL_RE = re.compile(r"\n{2,}")
+_WORD_RE = re.compile(r"\b\w+\b")
+_LAST_DIGIT_RE = re.compile(r"(\d)\D*$")
+
 def _now():
     return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
@@ -48,11 +76,11 @@ def _get_prolific_id():
     return request.cookies.get("prolific_id", "").strip()
 
 def _last_digit(s: str):
-    for ch in reversed(s):
-        if ch.isdigit():
-            return int(ch)
-    return None
+    m = _LAST_DIGIT_RE.search(s)
+    return int(m.group(1)) if m else None
 
+# a participant's ID never changes, and this runs several times per request
+@lru_cache(maxsize=4096)
 def choose_group_and_dir(prolific_id: str):
     """Return (group_num, directory_path). group=1 -> webpages; group=2 -> webpages2."""
     d = _last_digit(prolific_id or "")
@@ -61,34 +89,138 @@ def choose_group_and_dir(prolific_id: str):
         return 1, WEBPAGES_DIR
     return (1, WEBPAGES_DIR) if (d % 2 == 1) else (2, WEBPAGES2_DIR)
 
+EVENTS_HEADER = ["timestamp","prolific_id","type","query","target","sources","overview","分组"]
+
+# events(ts, pid, type, query, target, sources, overview, grp) mirrors EVENTS_HEADER
+_EVENTS_COLUMNS = "ts, pid, type, query, target, sources, overview, grp"
+_EVENTS_INSERT = f"INSERT INTO events ({_EVENTS_COLUMNS}) VALUES ({', '.join('?' * len(EVENTS_HEADER))})"
+
+def _events_db():
+    db = sqlite3.connect(EVENTS_DB, timeout=10)
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+def _init_events_db():
+    """Create events.db (WAL mode) and import a legacy events.csv once. Runs at import."""
+    n = len(EVENTS_HEADER)
+    with closing(_events_db()) as db:
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(f"CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, {_EVENTS_COLUMNS})")
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        try:
+            # take the write lock first so workers starting together import the CSV only once
+            db.execute("BEGIN IMMEDIATE")
+            done = db.execute("SELECT 1 FROM meta WHERE key = 'events_csv_imported'").fetchone()
+            if not done and os.path.exists(EVENTS_LOG):
+                with open(EVENTS_LOG, "r", encoding="utf-8") as f:
+                    reader = csv.reader(f)
+                    next(reader, None)  # header
+                    # pad/trim rows from older schemas to the current column count
+                    db.executemany(_EVENTS_INSERT, ((r + [""] * n)[:n] for r in reader))
+                # recorded in the same transaction as the rows, so the import happens exactly once
+                db.execute("INSERT INTO meta (key, value) VALUES ('events_csv_imported', ?)", (_now(),))
+                done = True
+            db.commit()
+        except Exception:
+            # leave the CSV where it is for the next start rather than failing startup
+            db.rollback()
+            app.logger.exception("could not import %s into %s; earlier events are missing from the DB", EVENTS_LOG, EVENTS_DB)
+            return
+    if done and os.path.exists(EVENTS_LOG):
+        # keep the old file around under a name the app no longer reads
+        try:
+            os.replace(EVENTS_LOG, EVENTS_LOG + ".imported")
+        except OSError:
+            app.logger.exception("could not rename imported %s", EVENTS_LOG)
+
+_init_events_db()
+
+SUBMISSIONS_HEADER = ["timestamp", "prolific_id", "query", "word_count", "text"]
+_ensure_csv(SUBMISSIONS_LOG, SUBMISSIONS_HEADER)
+
+# Log rows are queued by request threads and written in batches by one
+# background thread: one INSERT transaction per batch for EVENTS_DB, and
+# long-lived append-mode handles for the CSV logs.
+_LOG_QUEUE = queue.Queue()  # (path, row), or None to stop
+_LOG_BATCH_MAX = 100
+_LOG_BATCH_WAIT = 0.2  # seconds
+_LOG_LOCK = threading.Lock()  # guards the open handles and in-place truncation
+_log_files: dict = {}  # path -> (file, csv.writer)
+_log_flusher = None
+
+def _append_rows(path, rows):
+    if path == EVENTS_DB:
+        with closing(_events_db()) as db, db:
+            db.executemany(_EVENTS_INSERT, rows)
+        return
+    with _LOG_LOCK:
+        if path not in _log_files:
+            f = open(path, "a", newline="", encoding="utf-8")
+            _log_files[path] = (f, csv.writer(f))
+        f, w = _log_files[path]
+        w.writerows(rows)
+        f.flush()
+
+def _write_log_rows(batch):
+    by_path: dict[str, list] = {}
+    for path, row in batch:
+        by_path.setdefault(path, []).append(row)
+    for path, rows in by_path.items():
+        try:
+            _append_rows(path, rows)
+        except Exception:
+            # never drop study data: park the rows where they can be recovered by hand
+            app.logger.exception("could not write %d log rows to %s; saving them to %s", len(rows), path, UNWRITTEN_LOG)
+            try:
+                with open(UNWRITTEN_LOG, "a", encoding="utf-8") as f:
+                    for row in rows:
+                        f.write(json.dumps({"path": os.path.basename(path), "row": row}, ensure_ascii=False) + "\n")
+            except Exception:
+                app.logger.exception("could not save %d log rows for %s: %r", len(rows), path, rows)
+
+def _log_flush_loop():
+    while True:
+        item = _LOG_QUEUE.get()
+        stop = item is None
+        batch = [] if stop else [item]
+        deadline = time.monotonic() + _LOG_BATCH_WAIT
+        while not stop and len(batch) < _LOG_BATCH_MAX:
+            wait = deadline - time.monotonic()
+            if wait <= 0:
+                break
+            try:
+                item = _LOG_QUEUE.get(timeout=wait)
+            except queue.Empty:
+                break
+            if item is None:
+                stop = True
+            else:
+                batch.append(item)
+        if batch:
+            _write_log_rows(batch)
+        if stop:
+            return
+
+def _stop_log_flusher():
+    # the sentinel queues behind every pending row, so they are all written first
+    if _log_flusher is not None and _log_flusher.is_alive():
+        _LOG_QUEUE.put(None)
+        _log_flusher.join(timeout=5)
+
+def _enqueue_log_row(path, row):
+    global _log_flusher
+    # started lazily so it also exists in workers forked after import
+    if _log_flusher is None:
+        with _LOG_LOCK:
+            if _log_flusher is None:
+                _log_flusher = threading.Thread(target=_log_flush_loop, name="log-flusher", daemon=True)
+                _log_flusher.start()
+                atexit.register(_stop_log_flusher)
+    _LOG_QUEUE.put((path, row))
+
 def record_event(ev_type: str, query: str = "", target: str = "", sources=None, overview_text: str = ""):
     pid = _get_prolific_id()
     group, _ = choose_group_and_dir(pid)
-    expected_header = ["timestamp","prolific_id","type","query","target","sources","overview","分组"]
-    # ensure file and upgrade header if needed
-    if not os.path.exists(EVENTS_LOG):
-        with open(EVENTS_LOG, "w", newline="", encoding="utf-8") as f:
-            csv.writer(f).writerow(expected_header)
-    else:
-        # check header
-        try:
-            with open(EVENTS_LOG, "r", encoding="utf-8") as f:
-                rows = [r for r in csv.reader(f)]
-            if rows:
-                header = rows[0]
-                if header != expected_header:
-                    # upgrade: pad existing rows to new schema
-                    new_rows = [expected_header]
-                    for r in rows[1:]:
-                        r = r + [""] * max(0, len(expected_header)-len(r))
-                        new_rows.append(r[:len(expected_header)])
-                    with open(EVENTS_LOG, "w", newline="", encoding="utf-8") as f:
-                        w = csv.writer(f)
-                        w.writerows(new_rows)
-        except Exception:
-            # if any error, rewrite header
-            with open(EVENTS_LOG, "w", newline="", encoding="utf-8") as f:
-                csv.writer(f).writerow(expected_header)
     # serialize fields
     if sources is None:
         sources_str = ""
@@ -103,107 +235,219 @@ def record_event(ev_type: str, query: str = "", target: str = "", sources=None,
             sources_str = str(sources)
     ov = overview_text or ""
     row = [_now(), pid, ev_type, _clean(query, 4000), _clean(target, 4000), _clean(sources_str, 8000), _clean(ov, 16000), str(group)]
-    with open(EVENTS_LOG, "a", newline="", encoding="utf-8") as f:
-        csv.writer(f).writerow(row)
+    _enqueue_log_row(EVENTS_DB, row)
 
 def record_submission(query: str, text: str):
     pid = _get_prolific_id()
-    header = ["timestamp", "prolific_id", "query", "word_count", "text"]
-    _ensure_csv(SUBMISSIONS_LOG, header)
     wc = len((text or "").split())
     row = [_now(), pid, _clean(query, 2000), str(wc), text or ""]
-    with open(SUBMISSIONS_LOG, "a", newline="", encoding="utf-8") as f:
-        csv.writer(f).writerow(row)
+    _enqueue_log_row(SUBMISSIONS_LOG, row)
+
+_CLEAN_TBL = str.maketrans({"\r": " ", "\n": " "})
 
 def _clean(s, limit=4096):
-    try:
-        s = s or ""
-        if isinstance(s, (list, dict)):
-            s = str(s)
-        s = s.replace("\r", " ").replace("\n", " ").strip()
-    except Exception:
-        return (str(s) if s is not None else "")[:limit]
-    return s[:limit]
+    s = s or ""
+    if not isinstance(s, str):
+        s = str(s)
+    return s.translate(_CLEAN_TBL).strip()[:limit]
+
+# Text nodes under an element, skipping script/style/noscript content (comments aren't text nodes)
+_TEXT_XPATH = etree.XPath("descendant-or-self::text()[not(ancestor::script or ancestor::style or ancestor::noscript)]")
+
+def _text_of(el, sep=" "):
+    # same joining as BeautifulSoup's get_text(sep, strip=True)
+    return sep.join(t.strip() for t in _TEXT_XPATH(el) if t.strip())
 
-def guess_title_and_text_and_url(html_path):
+# lxml refuses str input that carries an XML encoding declaration, so pages are parsed as bytes
+_HTML_PARSER = lxml.html.HTMLParser(encoding="utf-8")
+
+def guess_title_and_text(html_path):
     try:
-        with open(html_path, "r", encoding="utf-8", errors="ignore") as f:
-            soup = BeautifulSoup(f.read(), "html.parser")
+        with open(html_path, "rb") as f:
+            # round-trip through str to drop invalid UTF-8, as errors="ignore" did before
+            data = f.read().decode("utf-8", errors="ignore").encode("utf-8")
+        root = lxml.html.document_fromstring(data, parser=_HTML_PARSER)
     except Exception:
-        return (os.path.basename(html_path), "", None, os.path.basename(html_path))
+        return (os.path.basename(html_path), "", os.path.basename(html_path))
 
     # title
     title = None
-    if soup.title and soup.title.text.strip():
-        title = soup.title.text.strip()
+    title_el = root.find(".//title")
+    if title_el is not None and title_el.text_content().strip():
+        title = title_el.text_content().strip()
     else:
-        h1 = soup.find("h1")
-        if h1 and h1.get_text(strip=True):
-            title = h1.get_text(strip=True)
+        h1 = root.find(".//h1")
+        if h1 is not None and _text_of(h1, ""):
+            title = _text_of(h1, "")
     if not title:
         title = os.path.basename(html_path)
 
-    # text
-    for tag in soup(["script", "style", "noscript"]):
-        tag.decompose()
-    text = soup.get_text(" ", strip=True)
+    # text: the <title> plus the body
+    parts = [_text_of(el) for el in (title_el, root.find("body")) if el is not None]
+    text = " ".join(p for p in parts if p)
 
-    # always use local route
-    dir_name = os.path.basename(os.path.dirname(html_path))
-    file_name = os.path.basename(html_path)
-    local_url = url_for("serve_page", dir=dir_name, name=file_name, _external=False)
+    return (title, text, os.path.basename(html_path))
 
-    return (title, text, local_url, file_name)
+# dir_path -> (signature of the files parsed, pages, index)
+_PAGES_CACHE: dict[str, tuple[tuple, list[dict], dict]] = {}
 
 def load_pages_from_dir(dir_path, limit=60):
-    files = sorted(glob.glob(os.path.join(dir_path, "*.html")))
+    """Return (pages, index) for the first `limit` pages in dir_path.
+
+    index["postings"] maps each term to [(page_id, tf), ...]; page ids are
+    positions in `pages`. index["page_lens"] holds each page's token count.
+    """
+    files = sorted(glob.glob(os.path.join(dir_path, "*.html")))[:limit]
+    # the corpora are static; only re-parse when a file is added, removed or touched
+    sig = tuple((os.path.basename(fp), st.st_mtime, st.st_size) for fp, st in zip(files, map(os.stat, files)))
+    cached = _PAGES_CACHE.get(dir_path)
+    if cached and cached[0] == sig:
+        return cached[1], cached[2]
+    dir_name = os.path.basename(dir_path)
+    # always use local route; names are plain *.html file names, so one url_for
+    # for the route plus urlencode matches what url_for would build per page
+    page_route = url_for("serve_page", _external=False)
     pages = []
-    for fp in files[:limit]:
-        title, text, url, fname = guess_title_and_text_and_url(fp)
+    postings: dict[str, list[tuple[int, int]]] = {}
+    page_lens: list[int] = []
+    for page_id, fp in enumerate(files):
+        title, text, fname = guess_title_and_text(fp)
+        tokens = _WORD_RE.findall(text.lower())
+        for w, c in Counter(tokens).items():
+            postings.setdefault(w, []).append((page_id, c))
+        page_lens.append(len(tokens))
         pages.append({
             "title": title,
             "text": text,
-            "href": url,
+            "href": f"{page_route}?{urlencode({'dir': dir_name, 'name': fname})}",
             "name": fname,
-            "dir": os.path.basename(dir_path),
+            "dir": dir_name,
         })
-    return pages
+    n = len(pages)
+    index = {
+        "postings": postings,
+        "page_lens": page_lens,
+        "avg_len": (sum(page_lens) / n) if n else 0.0,
+        "idf": {w: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for w, p in postings.items()},
+    }
+    _PAGES_CACHE[dir_path] = (sig, pages, index)
+    return pages, index
 
-def score_query(text, q):
-    if not text or not q:
-        return 0
-    words = [w.lower() for w in re.findall(r"\b\w+\b", q) if len(w) > 2]
-    if not words:
-        return 0
-    lt = text.lower()
-    return sum(lt.count(w) for w in words)
+def score_query(q, index, k1=1.2, b=0.75):
+    """BM25 scores {page_id: score} for pages containing a query word (longer than 2 chars)."""
+    scores: dict[int, float] = {}
+    if not q:
+        return scores
+    # a set, so a word repeated in the query is only scored once
+    words = {w for w in _WORD_RE.findall(q.lower()) if len(w) > 2}
+    page_lens = index["page_lens"]
+    avg_len = index["avg_len"] or 1.0
+    for w in words:
+        idf = index["idf"].get(w)
+        if idf is None:
+            continue
+        for page_id, tf in index["postings"][w]:
+            norm = k1 * (1 - b + b * page_lens[page_id] / avg_len)
+            scores[page_id] = scores.get(page_id, 0.0) + idf * tf * (k1 + 1) / (tf + norm)
+    return scores
+
+def rank_pages(query, pages, index, max_sources=8):
+    scores = score_query(query, index)
+    if not scores:
+        return pages[:max_sources]
+    # sort by page id first so equal scores keep directory order
+    top = sorted(sorted(scores), key=scores.get, reverse=True)[:max_sources]
+    return [pages[i] for i in top]
+
+# === EXACT INSTRUCTIONS REQUIRED BY USER ===
+_PROMPT_RULES = (
+    "INSTRUCTIONS:\n"
+    "Assume that you are the Google AI Overview generator, which is a feature integrated into Google Search that provides AI-generated summaries of search results. "
+    "Please answer the following query in one paragraph based on the HTMLs provided. For each factual sentence, append inline citation(s)\n"
+    "like [1] or [2][5]. Avoid markdown headings, bullet lists, disclaimers.\n"
+    "End with the overview only.\n"
+)
 
 def build_prompt(query, ranked_pages):
     numbered = []
     for i, p in enumerate(ranked_pages, start=1):
-        snippet = re.sub(r"\s+", " ", p.get("text","")).strip()
+        # bound the regex work: 6000 raw chars leave headroom for whitespace collapse
+        raw = p.get("text","")
+        snippet = _WS_RE.sub(" ", raw[:6000]).strip()
         if len(snippet) > 3000:
             snippet = snippet[:3000] + "…"
+        elif len(raw) > 6000:
+            snippet += "…"
         title = p.get("title") or p.get("name") or f"Source {i}"
         numbered.append(f"[{i}] {title}\n{snippet}")
     sources_blob = "\n\n".join(numbered)
 
-    # === EXACT INSTRUCTIONS REQUIRED BY USER ===
-    system_rules = (
-        "INSTRUCTIONS:\n"
-        "Assume that you are the Google AI Overview generator, which is a feature integrated into Google Search that provides AI-generated summaries of search results. "
-        "Please answer the following query in one paragraph based on the HTMLs provided. For each factual sentence, append inline citation(s)\n"
-        "like [1] or [2][5]. Avoid markdown headings, bullet lists, disclaimers.\n"
-        "End with the overview only.\n"
-    )
-
     # We keep QUERY and SOURCES sections, but the instruction text is exactly as above.
-    prompt = f"QUERY:\n{query}\n\nSOURCES:\n{sources_blob}\n\n{system_rules}"
+    prompt = f"QUERY:\n{query}\n\nSOURCES:\n{sources_blob}\n\n{_PROMPT_RULES}"
     return prompt
 
-def generate_overview(query, pages, max_sources=8):
+# Gemini answers keyed by (model, instructions, normalized query, ranked sources): in-process LRU in front of sqlite
+_OVERVIEW_LRU: OrderedDict[str, str] = OrderedDict()
+_OVERVIEW_LRU_MAX = 512
+_OVERVIEW_LOCK = threading.Lock()
+# the model and instructions are part of every key, so changing either retires old answers
+_OVERVIEW_KEY_PREFIX = f"{GENAI_MODEL}:{blake2b(_PROMPT_RULES.encode('utf-8'), digest_size=8).hexdigest()}"
+
+def _init_overview_cache():
+    with closing(sqlite3.connect(OVERVIEW_CACHE_DB)) as db, db:
+        db.execute("CREATE TABLE IF NOT EXISTS overviews (key TEXT PRIMARY KEY, text TEXT NOT NULL)")
+
+_init_overview_cache()
+
+def _overview_key(query, ranked_pages):
+    q_norm = " ".join((query or "").lower().split())
+    # webpages/ and webpages2/ share file names, so the dir is part of the key
+    srcs = [f"{p.get('dir','')}/{p.get('name','')}" for p in ranked_pages]
+    return blake2b(json.dumps([_OVERVIEW_KEY_PREFIX, q_norm, srcs]).encode("utf-8"), digest_size=16).hexdigest()
+
+def _get_cached_overview(key):
+    with _OVERVIEW_LOCK:
+        if key in _OVERVIEW_LRU:
+            _OVERVIEW_LRU.move_to_end(key)
+            return _OVERVIEW_LRU[key]
+    try:
+        with closing(sqlite3.connect(OVERVIEW_CACHE_DB, timeout=5)) as db, db:
+            row = db.execute("SELECT text FROM overviews WHERE key = ?", (key,)).fetchone()
+    except sqlite3.Error:
+        return None
+    if row:
+        _put_lru(key, row[0])
+        return row[0]
+    return None
+
+def _put_lru(key, text):
+    with _OVERVIEW_LOCK:
+        _OVERVIEW_LRU[key] = text
+        _OVERVIEW_LRU.move_to_end(key)
+        while len(_OVERVIEW_LRU) > _OVERVIEW_LRU_MAX:
+            _OVERVIEW_LRU.popitem(last=False)
+
+def _store_overview(key, text):
+    _put_lru(key, text)
+    try:
+        with closing(sqlite3.connect(OVERVIEW_CACHE_DB, timeout=5)) as db, db:
+            db.execute("INSERT OR REPLACE INTO overviews (key, text) VALUES (?, ?)", (key, text))
+    except sqlite3.Error:
+        pass
+
+def _strip_tags(text):
+    """Plain text of untrusted model output: tags dropped, entities decoded."""
+    if not text:
+        return ""
+    try:
+        return _text_of(lxml.html.fragment_fromstring(text, create_parent="div"))
+    except Exception:
+        return ""
+
+def generate_overview(query, pages, index, max_sources=8):
+    """Return (overview_html, overview_text, citations, ranked_pages)."""
     # rank pages
-    ranked = sorted(pages, key=lambda p: score_query(p.get("text",""), query), reverse=True)[:max_sources]
+    ranked = rank_pages(query, pages, index, max_sources)
 
     prompt = build_prompt(query, ranked)
 
@@ -215,20 +459,26 @@ def generate_overview(query, pages, max_sources=8):
         # Clicks route through /out with explicit dir/name to ensure we log local file names
         out_url = url_for("out_click", dir=d, name=n, q=query, _external=False)
         citations.append({"idx": i, "title": p.get("title") or p.get("name") or f"Source {i}", "href": out_url})
-    overview_html = None
+    overview_text = None
 
-    if _GENAI_READY:
+    cache_key = _overview_key(query, ranked)
+    cached = _get_cached_overview(cache_key)
+    if cached:
+        overview_text = cached
+    elif _GENAI_READY:
         try:
-            model = genai.GenerativeModel("gemini-1.5-flash")
-            resp = model.generate_content(prompt)
-            text = (resp.text or "").strip()
+            resp = _MODEL.generate_content(prompt, request_options={"timeout": GENAI_TIMEOUT})
+            # the reply can be steered by page content, so keep only its text
+            text = _strip_tags((resp.text or "").strip())
             # Ensure it's a single paragraph string
-            text = re.sub(r"\n{2,}", " ", text)
-            overview_html = f'<div id="overview"><p style="font-size:17px;line-height:1.65">{text}</p></div>'
+            text = _NL_RE.sub(" ", text)
+            if text:
+                _store_overview(cache_key, text)
+            overview_text = text
         except Exception as e:
-            overview_html = None
+            overview_text = None
 
-    if not overview_html:
+    if overview_text is None:
         # Fallback: simple stitched sentence with citations [1], [2], etc.
         parts = []
         for i, p in enumerate(ranked, start=1):
@@ -236,10 +486,10 @@ def generate_overview(query, pages, max_sources=8):
             parts.append(f"{t} [{i}]")
             if len(parts) >= 4:
                 break
-        sentence = "; ".join(parts) + "." if parts else "No relevant content found."
-        overview_html = f'<div id="overview"><p style="font-size:17px;line-height:1.65">{sentence}</p></div>'
+        overview_text = "; ".join(parts) + "." if parts else "No relevant content found."
 
-    return overview_html, citations
+    overview_html = f'<div id="overview"><p style="font-size:17px;line-height:1.65">{escape(overview_text)}</p></div>'
+    return overview_html, overview_text, citations, ranked
 
 # ------------------------------
 # Routes
@@ -265,26 +515,16 @@ def results():
     q = request.args.get("q","").strip()
     pid = _get_prolific_id()
     group, dir_path = choose_group_and_dir(pid)
+    overview_html = None
     overview_text = None
     citations = []
     if q:
-        pages = load_pages_from_dir(dir_path, limit=80)
-        overview_html, citations = generate_overview(q, pages)
-        # extract text inside <p> if present
-        try:
-            soup = BeautifulSoup(overview_html, "html.parser")
-            ptag = soup.find("p")
-            overview_text = ptag.get_text(" ", strip=True) if ptag else soup.get_text(" ", strip=True)
-        except Exception:
-            overview_text = None
+        pages, index = load_pages_from_dir(dir_path, limit=PAGES_LIMIT)
+        overview_html, overview_text, citations, ranked = generate_overview(q, pages, index)
         # build sources list of local file names in ranked order
-        # We reconstruct ranked order similar to generate_overview
-        ranked = sorted(pages, key=lambda p: score_query(p.get("text",""), q), reverse=True)[:8]
         src_names = [p.get("name","") for p in ranked]
         record_event("overview", q, f"{len(pages)} candidates from {os.path.basename(dir_path)}", sources=src_names, overview_text=overview_text or "")
-    return render_template('results.html', title='Results', query=q, overview=overview_text, citations=citations, prolific_id=pid,)
-
-    return render_template("results.html", title="Results", query=q, overview_html=overview_html, citations=citations, prolific_id=pid)
+    return render_template("results.html", title="Results", query=q, overview=overview_text, overview_html=overview_html, citations=citations, prolific_id=pid)
 
 @app.route("/api/overview", methods=["POST"])
 def api_overview():
@@ -296,23 +536,11 @@ def api_overview():
         return {"error": "missing query"}, 400
 
     # Load candidate pages and generate the overview + citations
-    pages = load_pages_from_dir(dir_path, limit=80)
-    overview_html, citations = generate_overview(q, pages)
-
-    # Extract plain text from the overview HTML for logging/storage
-    try:
-        soup = BeautifulSoup(overview_html or "", "html.parser")
-        ptag = soup.find("p")
-        overview_text = ptag.get_text(" ", strip=True) if ptag else soup.get_text(" ", strip=True)
-    except Exception:
-        overview_text = ""
+    pages, index = load_pages_from_dir(dir_path, limit=PAGES_LIMIT)
+    overview_html, overview_text, citations, ranked = generate_overview(q, pages, index)
 
     # Build and log the ranked source local file names (not external URLs)
-    try:
-        ranked = sorted(pages, key=lambda p: score_query(p.get("text", ""), q), reverse=True)[:8]
-        src_names = [p.get("name", "") for p in ranked]
-    except Exception:
-        src_names = []
+    src_names = [p.get("name", "") for p in ranked]
 
     record_event("overview", q, f"{len(pages)} candidates from {os.path.basename(dir_path)}", sources=src_names, overview_text=overview_text or "")
 
@@ -333,12 +561,6 @@ def out_click():
         return redirect(url_for("results"))
     # build local /page url
     return redirect(url_for("serve_page", dir=d, name=target_name, _external=False))
-    # fallback to results
-    return redirect(url_for("results"))
-    # only allow http/https
-    if not (url.startswith("http://") or url.startswith("https://")):
-        return redirect(url_for("results"))
-    return redirect(url)
 
 @app.route("/page")
 def serve_page():
@@ -354,7 +576,10 @@ def serve_page():
     path = os.path.join(directory, name)
     if not os.path.isfile(path):
         abort(404)
-    return send_from_directory(directory, name)
+    # per-route rather than SEND_FILE_MAX_AGE_DEFAULT so the admin CSV downloads stay uncached
+    resp = send_from_directory(directory, name, max_age=PAGE_MAX_AGE)
+    resp.headers["Cache-Control"] = f"public, max-age={PAGE_MAX_AGE}, immutable"
+    return resp
 
 # ------------------------------
 # Admin (simple cookie gate)
@@ -386,28 +611,41 @@ def admin_logout():
 def admin_events():
     if not check_admin():
         return redirect(url_for("admin_login", next=url_for("admin_events")))
-    rows = []
-    if os.path.exists(EVENTS_LOG):
-        with open(EVENTS_LOG, "r", encoding="utf-8") as f:
-            rows = [r for r in csv.reader(f)]
-    return render_template("admin_events.html", title="Admin Events", rows=rows)
+    page = max(request.args.get("page", 1, type=int), 1)
+    size = min(max(request.args.get("size", 200, type=int), 1), 1000)
+    with closing(_events_db()) as db:
+        # fetch one extra row to know whether a next page exists
+        chunk = db.execute(f"SELECT {_EVENTS_COLUMNS} FROM events ORDER BY id LIMIT ? OFFSET ?",
+                           (size + 1, (page - 1) * size)).fetchall()
+    has_next = len(chunk) > size
+    rows = [EVENTS_HEADER] + [list(r) for r in chunk[:size]]
+    return render_template("admin_events.html", title="Admin Events", rows=rows, page=page, size=size, has_next=has_next)
 
 @app.route("/admin/events/download")
 def admin_events_download():
     if not check_admin():
         return redirect(url_for("admin_login", next=url_for("admin_events_download")))
-    if not os.path.exists(EVENTS_LOG):
-        with open(EVENTS_LOG, "w", newline="", encoding="utf-8") as f:
-            csv.writer(f).writerow(["timestamp","prolific_id","type","query","target","sources","overview","分组"])
-    return send_from_directory(LOGS_DIR, os.path.basename(EVENTS_LOG), as_attachment=True)
+    def generate():
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        w.writerow(EVENTS_HEADER)
+        with closing(_events_db()) as db:
+            for r in db.execute(f"SELECT {_EVENTS_COLUMNS} FROM events ORDER BY id"):
+                w.writerow(r)
+                if buf.tell() > 64 * 1024:
+                    yield buf.getvalue()
+                    buf.seek(0)
+                    buf.truncate()
+        yield buf.getvalue()
+    return Response(generate(), mimetype="text/csv",
+                    headers={"Content-Disposition": "attachment; filename=events.csv"})
 
 @app.route("/admin/events/clear", methods=["POST"])
 def admin_events_clear():
     if not check_admin():
         return redirect(url_for("admin_login", next=url_for("admin_events")))
-    header = ["timestamp","prolific_id","type","query","target","sources","overview","分组"]
-    with open(EVENTS_LOG, "w", newline="", encoding="utf-8") as f:
-        csv.writer(f).writerow(header)
+    with closing(_events_db()) as db, db:
+        db.execute("DELETE FROM events")
     return redirect(url_for("admin_events"))
 
 @app.route("/admin/logs")
@@ -425,16 +663,16 @@ def admin_logs_download():
     if not check_admin():
         return redirect(url_for("admin_login", next=url_for("admin_logs_download")))
     if not os.path.exists(SUBMISSIONS_LOG):
-        _ensure_csv(SUBMISSIONS_LOG, ["timestamp","prolific_id","query","word_count","text"])
+        _ensure_csv(SUBMISSIONS_LOG, SUBMISSIONS_HEADER)
     return send_from_directory(LOGS_DIR, os.path.basename(SUBMISSIONS_LOG), as_attachment=True)
 
 @app.route("/admin/logs/clear", methods=["POST"])
 def admin_logs_clear():
     if not check_admin():
         return redirect(url_for("admin_login", next=url_for("admin_logs")))
-    header = ["timestamp","prolific_id","query","word_count","text"]
-    with open(SUBMISSIONS_LOG, "w", newline="", encoding="utf-8") as f:
-        csv.writer(f).writerow(header)
+    # truncate in place; the long-lived append handle keeps writing at the new end
+    with _LOG_LOCK, open(SUBMISSIONS_LOG, "w", newline="", encoding="utf-8") as f:
+        csv.writer(f).writerow(SUBMISSIONS_HEADER)
     return redirect(url_for("admin_logs"))
 
 # ------------------------------
@@ -448,6 +686,22 @@ def submit():
     record_event("submit", q, f"{len(text.split())} words")
     return render_template("thanks.html", title="Thank you")
 
+# ------------------------------
+# Warm-up
+# ------------------------------
+def warm_page_cache():
+    """Parse and index both corpora up front so the first search doesn't pay for it."""
+    with app.test_request_context():
+        for d in (WEBPAGES_DIR, WEBPAGES2_DIR):
+            try:
+                load_pages_from_dir(d, limit=PAGES_LIMIT)
+            except Exception:
+                # requests will retry the parse on their own cache miss
+                app.logger.exception("could not warm the page cache for %s", d)
+
+# at import, before gunicorn's request threads exist
+warm_page_cache()
+
 # ------------------------------
 # Run
 # ------------------------------